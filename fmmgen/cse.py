@@ -37,6 +37,9 @@ def tree_cse(exprs, symbols, opt_subs=None, order='canonical', ignore=()):
     if opt_subs is None:
         opt_subs = dict()
 
+    # Compare by name, as the symbols may be MatrixSymbols or plain Symbols.
+    ignore = {str(i) for i in ignore}
+
     # Find repeated sub-expressions
 
     to_eliminate = set()
@@ -62,13 +65,8 @@ def tree_cse(exprs, symbols, opt_subs=None, order='canonical', ignore=()):
 
         else:
             if expr in seen_subexp:
-                # print(expr.free_symbols)
-                for ign in ignore:
-                    if str(ign) in [str(i) for i in expr.free_symbols]:
-                        # print(f'Skipping {expr}')
-                        break
-                        
-                else:
+                if not (ignore and ignore.intersection(
+                        str(i) for i in expr.free_symbols)):
                     to_eliminate.add(expr)
                     return
 
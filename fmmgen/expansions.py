@@ -7,10 +7,35 @@ import functools
 import logging
 logger = logging.getLogger(name="fmmgen")
 
+try:
+    import symengine
+except ImportError:
+    symengine = None
+
 def fact(n):
     nx, ny, nz = n
     return factorial(nx)*factorial(ny)*factorial(nz)
 
+@functools.lru_cache(maxsize=None)
+def monomial(n, symbols):
+    """
+    monomial(n, symbols)
+
+    Returns symbolic expression for the n = (nx, ny, nz) Taylor series
+    monomial x**nx * y**ny * z**nz / (nx! ny! nz!)
+
+    The same monomials occur in the terms of many operators, so they are
+    cached. Note that symbols *must* be a tuple for the functools.lru_cache
+    to hash the input.
+
+    >>> x, y, z = sp.symbols('x y z')
+    >>> monomial((2, 1, 0), (x, y, z))
+    x**2*y/2
+    """
+    x, y, z = symbols
+    return x**n[0] * y**n[1] * z**n[2] / fact(n)
+
+
 def binom(n, k):
     nx, ny, nz = n
     kx, ky, kz = k
@@ -64,16 +89,16 @@ def M_shift(n, order, symbols, index_dict, source_order=0):
     if modn < source_order:
         raise ValueError('sum(n) must be greater than or equal to source_order')
 
-    result = sp.Integer(0)
+    terms = []
     for i, k in enumerate(monoms.keys()):
         nmink = n[0] - k[0], n[1] - k[1], n[2] - k[2]
         if nmink[0] >= 0 and nmink[1] >= 0 and nmink[2] >= 0 and sum(nmink) >= source_order:
             array_index = index_dict[nmink]
             M = sp.MatrixSymbol('M', Nterms(order), 1)[array_index]
-            sum_term = M * x**k[0] * y**k[1] * z**k[2] / fact(k)
-            result += sum_term
+            sum_term = M * monomial(k, tuple(symbols))
+            terms.append(sum_term)
 
-    return result
+    return sp.Add(*terms)
 
 
 def M_dipole(n, symbols, M_dict):
@@ -101,6 +126,21 @@ def M_dipole(n, symbols, M_dict):
     return term.subs(replacement_dict)
 
 
+def _symengine_inverse_R_deriv(n, symbols):
+    """
+    Differentiates 1/R with symengine, which is much faster than sympy
+    at high order, and returns the expanded result as a sympy expression.
+    """
+    se_symbols = [symengine.Symbol(str(s)) for s in symbols]
+    dx, dy, dz = se_symbols
+    deriv = 1/symengine.sqrt(dx**2 + dy**2 + dz**2)
+    for symbol, k in zip(se_symbols, n):
+        for _ in range(k):
+            deriv = symengine.diff(deriv, symbol)
+    deriv = sp.sympify(symengine.expand(deriv))
+    return deriv.xreplace({sp.Symbol(str(s)): s for s in symbols})
+
+
 @functools.lru_cache(maxsize=None)
 def Phi_derivatives(n, symbols, harmonic=False):
     """
@@ -121,14 +161,18 @@ def Phi_derivatives(n, symbols, harmonic=False):
     >>> from fmmgen.expansions import Phi_derivatives
     >>> x, y, z = sp.symbols('x y z')
     >>> Phi_derivatives((1, 0, 0), (x, y, z))
-    -1.0*x/R**3
+    -x/R**3
     """
     if not harmonic or n[2] < 2:
         dx, dy, dz = symbols
-        R = (dx**2 + dy**2 + dz**2)**(0.5)
-        phi = 1/R
-        deriv = sp.diff(phi, dx, n[0], dy, n[1], dz, n[2])
-        deriv = deriv.subs(R, 'R')
+        R = sp.sqrt(dx**2 + dy**2 + dz**2)
+        if symengine is not None:
+            deriv = _symengine_inverse_R_deriv(n, symbols)
+        else:
+            deriv = sp.diff(1/R, dx, n[0], dy, n[1], dz, n[2])
+        # Expanding gives a sum of monomials over powers of R, which
+        # shares more subexpressions than sympy's nested rational form.
+        deriv = sp.expand(deriv.subs(R, 'R'))
         return deriv
     else:
         k = (n[0], n[1], n[2] - 2)
@@ -154,17 +198,17 @@ def L(n, order, symbols, M_dict, eval_derivs=True, source_order=0):
     if not eval_derivs:
         D = sp.MatrixSymbol('D', Nterms(order), 1)
 
-    result = sp.Integer(0)
+    terms = []
     for m in monoms.keys():
         npm = n[0] + m[0], n[1] + m[1], n[2] + m[2]
         #print(f'  m = {m}, npm = {npm}')
         if npm[0] >= 0 and npm[1] >= 0 and npm[2] >= 0 and sum(m) >= source_order:
             M = sp.MatrixSymbol('M', Nterms(order), 1)[M_dict[m]]
             if eval_derivs:
-                result += M*Phi_derivatives(npm, symbols)
+                terms.append(M*Phi_derivatives(npm, symbols))
             else:
-                result += M*D[M_dict[npm]]
-    return result
+                terms.append(M*D[M_dict[npm]])
+    return sp.Add(*terms)
 
 
 def L_shift(n, order, symbols, L_dict, source_order=0):
@@ -176,7 +220,7 @@ def L_shift(n, order, symbols, L_dict, source_order=0):
     # rather than using index_dict, because otherwise we miss terms!
     monoms, _ = generate_mappings(modk_max, symbols, key='grevlex', source_order=0)
 
-    result = sp.Integer(0)
+    terms = []
 
     for k in monoms.keys():
         npk = n[0] + k[0], n[1] + k[1], n[2] + k[2]
@@ -184,19 +228,45 @@ def L_shift(n, order, symbols, L_dict, source_order=0):
 
         if npk[0] >= 0 and npk[1] >= 0 and npk[2] >= 0 and sum(npk) <= order-source_order:
             L = sp.MatrixSymbol('L', Nterms(order), 1)[L_dict[npk]]
-            sum_term = L * x**k[0] * y**k[1] * z**k[2] / fact(k)
-            result += sum_term
-    return result
+            sum_term = L * monomial(k, tuple(symbols))
+            terms.append(sum_term)
+    return sp.Add(*terms)
 
 
 def phi_deriv(order, symbols, L_dict, deriv=(0, 0, 0), source_order=0):
     x, y, z = symbols
 
-    result = sp.Integer(0)
+    terms = []
     for n in L_dict.keys():
         L = sp.MatrixSymbol('L', Nterms(order), 1)[L_dict[n]]
         nmd = n[0] - deriv[0], n[1] - deriv[1], n[2] - deriv[2]
         if nmd[0] >= 0 and nmd[1] >= 0 and nmd[2] >= 0:
-            sum_term = L * x**nmd[0] * y**nmd[1] * z**nmd[2] / fact(nmd)
-            result += sum_term
-    return result
+            sum_term = L * monomial(nmd, tuple(symbols))
+            terms.append(sum_term)
+    return sp.Add(*terms)
+
+
+def phi_M_deriv(order, symbols, M_dict, deriv=(0, 0, 0), source_order=0):
+    """
+    phi_M_deriv(order, symbols, M_dict, deriv=(0, 0, 0))
+
+    Returns symbolic expression for the deriv = (dx, dy, dz) derivative
+    of the potential of a multipole expansion, evaluated directly at
+    the point (x, y, z) relative to the expansion centre.
+
+    Differentiating the expansion only shifts the index of the 1/R
+    derivative in each term, so no symbolic differentiation of the full
+    expansion is required.
+
+    >>> x, y, z = sp.symbols('x y z')
+    >>> M_dict, _ = generate_mappings(0, (x, y, z))
+    >>> phi_M_deriv(0, (x, y, z), M_dict, deriv=(1, 0, 0))
+    -x*M[0, 0]/R**3
+    """
+    terms = []
+    for m in M_dict.keys():
+        if sum(m) >= source_order:
+            M = sp.MatrixSymbol('M', Nterms(order), 1)[M_dict[m]]
+            mpd = m[0] + deriv[0], m[1] + deriv[1], m[2] + deriv[2]
+            terms.append(M*Phi_derivatives(mpd, tuple(symbols)))
+    return sp.Add(*terms)
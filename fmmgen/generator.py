@@ -1,82 +1,47 @@
 import sympy as sp
-from .expansions import M, M_shift, L, L_shift, phi_deriv, Phi_derivatives
-from sympy.polys.orderings import monomial_key
-from .utils import itermonomials, generate_mappings, Nterms
-from sympy.polys.monomials import itermonomials as sp_itermonomials
+from .expansions import M, M_shift, L, L_shift, phi_deriv, phi_M_deriv, \
+    Phi_derivatives
+from .utils import generate_mappings, Nterms
+import functools
+import multiprocessing
 import logging
 logger = logging.getLogger(name="fmmgen")
 
-def itermonomials(symbols, max_degree, min_degree=0):
-    monoms = list(sp_itermonomials(symbols, max_degree))
-    new_monoms = []
-    for monom in monoms:
-        monom_dict = monom.as_powers_dict()
-        order = 0
-        for symbol in symbols:
-            order += monom_dict[symbol]
-            if order >= min_degree:
-                new_monoms.append(monom)
-    return set(new_monoms)
 
-
-def generate_mappings(order, symbols, key='grevlex', source_order=0):
+def _map(func, indices, processes=1, pool=None):
     """
-    generate_mappings(order, symbols, key='grevlex'):
-
-    Generates a set of mappings between three-tuples of
-    indices denoting monomials and and array indices.
-    Returns both the forward and backward maps.
-
-    Inputs:
-    order: int
-        Maximum monomial order
-
-    symbols: list
-        List of sympy.Symbol type objects
-
-    source_order: int
-        Integer describing order of o
-
-    Returns:
-    dict:
-        Forward mapping from n-tuple to array index.
-
-    dict:
-        Reversed version; mapping from array index to
-        tuple mapping.
-
-    Example:
-    >>> x, y, z = sp.symbols('x y z')
-    >>> map, rmap = generate_mappings(1, [x, y, z])
-    >>> print(map):
-    {(0, 0, 0): 0, (1, 0, 0): 1, (0, 1, 0): 2, (0, 0, 1): 3}
-    >>> print(rmap):
-    {0: (0, 0, 0), 1: (1, 0, 0), 2: (0, 1, 0), 3: (0, 0, 1)}
+    Evaluates func for each monomial index tuple, returning the results
+    as a list in the order of indices. The operators for each index are
+    independent, so they can be farmed out to worker processes: either
+    to an existing multiprocessing.Pool passed as pool, or to a new pool
+    of processes workers if processes != 1 (None uses all available
+    cores). By default they are built serially.
+
+    Worker processes re-import the calling script under the spawn start
+    method (the default on macOS and Windows), so scripts which enable
+    them must call fmmgen from within an if __name__ == '__main__': block.
     """
-    if order < source_order:
-        raise ValueError(
-            "source_order must be <= order for meaningful calculations to occur"
-        )
-
-    x, y, z = symbols
-    rsymbols = [z, y, x]
+    indices = list(indices)
+    if pool is not None:
+        return pool.map(func, indices)
+    if processes == 1 or len(indices) < 2:
+        return [func(n) for n in indices]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(func, indices)
 
-    monoms = itermonomials(symbols, order, source_order)
-    if key:
-        monom_key = monomial_key(key, rsymbols)
-        monoms = sorted(monoms, key=monom_key)
 
-    index_dict = {}
-    rindex_dict = {}
-    for i, monom in enumerate(monoms):
-        d = monom.as_powers_dict()
-        n = d[x], d[y], d[z]
-        index_dict[n] = i
-        rindex_dict[i] = n
-    return index_dict, rindex_dict
+def _horner(expr, symbols):
+    """
+    Returns the multivariate Horner form of a polynomial in symbols. The
+    variable appearing in the most terms is used as the innermost one.
+    """
+    terms = sp.Add.make_args(sp.expand(expr))
+    counts = {s: sum(1 for t in terms if t.has(s)) for s in symbols}
+    gens = sorted(symbols, key=lambda s: counts[s])
+    return sp.horner(expr, *gens)
 
 
-def generate_M_operators(order, symbols, M_dict):
+def generate_M_operators(order, symbols, M_dict, processes=1, pool=None):
     """
     generate_M_operators(order, symbols, index_dict):
 
@@ -95,6 +60,14 @@ def generate_M_operators(order, symbols, M_dict):
         monomials of symbols and array indices,
         generated by generate_mappings or otherwise.
 
+    processes, int:
+        Number of worker processes used to build the operators. Defaults
+        to 1, which builds them serially; None uses all available cores.
+
+    pool, multiprocessing.Pool:
+        Existing pool of worker processes to build the operators with,
+        used instead of processes.
+
     Output:
     list:
         List of symbolic multipole moments up to order.
@@ -106,14 +79,12 @@ def generate_M_operators(order, symbols, M_dict):
     >>> generate_M_operators(order, (x, y, z), map)
     [q, -q*x, -q*y, -q*z, q*x**2/2, q*x*y, q*x*z, q*y**2/2, q*y*z, q*z**2/2]
     """
-    x, y, z = symbols
-    M_operators = []
-    for n in M_dict.keys():
-        M_operators.append(M(n, symbols))
-    return M_operators
+    func = functools.partial(M, symbols=symbols)
+    return _map(func, M_dict.keys(), processes, pool)
 
 
-def generate_M_shift_operators(order, symbols, M_dict, source_order=0):
+def generate_M_shift_operators(order, symbols, M_dict, source_order=0,
+                               processes=1, pool=None):
     """
     generate_M_shift_operators(order, symbols, index_dict):
 
@@ -131,6 +102,14 @@ def generate_M_shift_operators(order, symbols, M_dict, source_order=0):
         monomials of symbols and array indices, generated by generate_mappings
          or otherwise.
 
+    processes, int:
+        Number of worker processes used to build the operators. Defaults
+        to 1, which builds them serially; None uses all available cores.
+
+    pool, multiprocessing.Pool:
+        Existing pool of worker processes to build the operators with,
+        used instead of processes.
+
     Output:
     list:
         List of symbolic multipole shifting operators up to order.
@@ -142,12 +121,9 @@ def generate_M_shift_operators(order, symbols, M_dict, source_order=0):
     >>> generate_M_shift_operators(order, (x, y, z), map)
     [M[0, 0], x*M[0, 0] + M[1, 0], y*M[0, 0] + M[2, 0], z*M[0, 0] + M[3, 0]]
     """
-    x, y, z = symbols
-    M_operators = []
-    for n in M_dict.keys():
-        M_operators.append(M_shift(n, order, symbols, M_dict,
-                                   source_order=source_order))
-    return M_operators
+    func = functools.partial(M_shift, order=order, symbols=symbols,
+                             index_dict=M_dict, source_order=source_order)
+    return _map(func, M_dict.keys(), processes, pool)
 
 def generate_derivs(order, symbols, M_dict, source_order=0, harmonic_derivs=False):
     D = sp.MatrixSymbol('D', Nterms(order), 1)
@@ -162,7 +138,8 @@ def generate_derivs(order, symbols, M_dict, source_order=0, harmonic_derivs=Fals
             derivs.append(Phi_derivatives(n, symbols))
     return derivs
 
-def generate_L_operators(order, symbols, M_dict, L_dict, source_order=0):
+def generate_L_operators(order, symbols, M_dict, L_dict, source_order=0,
+                         processes=1, pool=None):
     """
     generate_L_operators(order, symbols, index_dict):
 
@@ -183,6 +160,14 @@ def generate_L_operators(order, symbols, M_dict, L_dict, source_order=0):
     inline_derivs: bool
         Calculate derivatives inline rather than precalculating these.
 
+    processes, int:
+        Number of worker processes used to build the operators. Defaults
+        to 1, which builds them serially; None uses all available cores.
+
+    pool, multiprocessing.Pool:
+        Existing pool of worker processes to build the operators with,
+        used instead of processes.
+
     Output:
     list:
         List of symbolic local expansion operators up to order.
@@ -195,15 +180,13 @@ def generate_L_operators(order, symbols, M_dict, L_dict, source_order=0):
     [M[0, 0]/R - 1.0*x*M[1, 0]/R**3 - 1.0*y*M[2, 0]/R**3 - 1.0*z*M[3, 0]/R**3,
     -1.0*x*M[0, 0]/R**3, -1.0*y*M[0, 0]/R**3, -1.0*z*M[0, 0]/R**3]
     """
-    x, y, z = symbols
-    L_operators = []
-    for n in L_dict.keys():
-        L_operators.append(L(n, order, symbols, M_dict, source_order=source_order, eval_derivs=False))
+    func = functools.partial(L, order=order, symbols=symbols, M_dict=M_dict,
+                             source_order=source_order, eval_derivs=False)
+    return _map(func, L_dict.keys(), processes, pool)
 
-    return L_operators
 
-
-def generate_L_shift_operators(order, symbols, L_dict, source_order=0):
+def generate_L_shift_operators(order, symbols, L_dict, source_order=0,
+                               processes=1, pool=None):
     """
     generate_L_shift_operators(order, symbols, index_dict):
 
@@ -222,6 +205,14 @@ def generate_L_shift_operators(order, symbols, L_dict, source_order=0):
         monomials of symbols and array indices,
         generated by generate_mappings or otherwise.
 
+    processes, int:
+        Number of worker processes used to build the operators. Defaults
+        to 1, which builds them serially; None uses all available cores.
+
+    pool, multiprocessing.Pool:
+        Existing pool of worker processes to build the operators with,
+        used instead of processes.
+
     Output:
     list:
         List of symbolic local expansion shifting operators up to order.
@@ -233,11 +224,9 @@ def generate_L_shift_operators(order, symbols, L_dict, source_order=0):
     >>> generate_L_shift_operators(order, (x, y, z), map)
     [x*L[1, 0] + y*L[2, 0] + z*L[3, 0] + L[0, 0], L[1, 0], L[2, 0], L[3, 0]]
     """
-    x, y, z = symbols
-    L_shift_operators = []
-    for n in L_dict.keys():
-        L_shift_operators.append(L_shift(n, order, symbols, L_dict, source_order=source_order))
-    return L_shift_operators
+    func = functools.partial(L_shift, order=order, symbols=symbols,
+                             L_dict=L_dict, source_order=source_order)
+    return _map(func, L_dict.keys(), processes, pool)
 
 
 def generate_M2P_operators(order, symbols, M_dict,
@@ -249,26 +238,28 @@ def generate_M2P_operators(order, symbols, M_dict,
     Generates potential and field calculation operators for the
     Barnes-Hut method up to order.
     """
-    x, y, z = symbols
-    R = (x**2 + y**2 + z**2)**0.5
-
     terms = []
 
-    V = L((0, 0, 0), order, symbols, M_dict, source_order=source_order, eval_derivs=True).subs('R', R)
     if potential:
-        terms.append(V.subs(R, 'R'))
+        V = phi_M_deriv(order, symbols, M_dict, deriv=(0, 0, 0),
+                        source_order=source_order)
+        terms.append(V)
 
     if field:
-        Fx = -sp.diff(V, x).subs(R, 'R')
-        Fy = -sp.diff(V, y).subs(R, 'R')
-        Fz = -sp.diff(V, z).subs(R, 'R')
+        Fx = -phi_M_deriv(order, symbols, M_dict, deriv=(1, 0, 0),
+                          source_order=source_order)
+        Fy = -phi_M_deriv(order, symbols, M_dict, deriv=(0, 1, 0),
+                          source_order=source_order)
+        Fz = -phi_M_deriv(order, symbols, M_dict, deriv=(0, 0, 1),
+                          source_order=source_order)
         terms.append(Fx)
         terms.append(Fy)
         terms.append(Fz)
 
     return terms
 
-def generate_L2P_operators(order, symbols, L_dict, potential=True, field=True):
+def generate_L2P_operators(order, symbols, L_dict, potential=True, field=True,
+                           horner=False):
     """
     generate_L2P_operators(order, symbols, index_dict):
 
@@ -286,6 +277,11 @@ def generate_L2P_operators(order, symbols, L_dict, potential=True, field=True):
         Forward mapping dictionary between monomials of symbols and array
         indices, generated by generate_mappings or otherwise.
 
+    horner, bool:
+        Rewrite the operators, which are polynomials in the symbols, in
+        multivariate Horner form. This reduces the op count of the
+        generated code once CSE has been applied.
+
     Output:
     list:
         List of symbolic field calculation operators from local expansions up to
@@ -313,28 +309,69 @@ def generate_L2P_operators(order, symbols, L_dict, potential=True, field=True):
         terms.append(Fx)
         terms.append(Fy)
         terms.append(Fz)
+
+    if horner:
+        terms = [_horner(term, symbols) for term in terms]
+    return terms
+
+def _P2P_monopole(symbols, potential, field):
+    x, y, z = symbols
+    R = sp.Symbol('R')
+    q = sp.MatrixSymbol('S', Nterms(0), 1)[0]
+
+    terms = []
+    if potential:
+        terms.append(q / R)
+
+    if field:
+        q_R3 = q / R**3
+        terms.append(x * q_R3)
+        terms.append(y * q_R3)
+        terms.append(z * q_R3)
     return terms
 
+
+def _P2P_dipole(symbols, potential, field):
+    x, y, z = symbols
+    R = sp.Symbol('R')
+    S = sp.MatrixSymbol('S', Nterms(1), 1)
+    mu = S[0], S[1], S[2]
+    mu_dot_r = mu[0]*x + mu[1]*y + mu[2]*z
+
+    terms = []
+    if potential:
+        terms.append(-mu_dot_r / R**3)
+
+    if field:
+        for r_i, mu_i in zip(symbols, mu):
+            terms.append(mu_i / R**3 - 3 * r_i * mu_dot_r / R**5)
+    return terms
+
+
 def generate_P2P_operators(symbols, M_dict, potential=True, field=True, source_order=0):
+    # Charges and dipoles have short closed forms, which are written
+    # out directly rather than derived from the multipole expansion.
+    if source_order == 0:
+        return _P2P_monopole(symbols, potential, field)
+    elif source_order == 1:
+        return _P2P_dipole(symbols, potential, field)
+    return _P2P_expansion(symbols, potential, field, source_order)
+
+
+def _P2P_expansion(symbols, potential, field, source_order):
     order = source_order
     M_dict, _ = generate_mappings(source_order, symbols, 'grevlex',
                                   source_order=source_order)
     x, y, z = sp.symbols('x y z')
-    R = (x**2 + y**2 + z**2) ** 0.5
-
-    S_map, _ = generate_mappings(source_order, [x, y, z], key='grevlex',
-                                 source_order=source_order)
-    # print('S_map = {}'.format(S_map))
+    R = sp.sqrt(x**2 + y**2 + z**2)
 
     M = sp.MatrixSymbol('M', Nterms(order), 1)
     S = sp.MatrixSymbol('S', Nterms(order), 1)
 
-    subsdict = {M[i]: 0 for i in range(Nterms(order))}
-
-    for key in S_map.keys():
-        subsdict[M[M_dict[key]]] = S[M_dict[key]]
+    subsdict = {M[i]: S[i] for i in M_dict.values()}
+    subsdict[sp.Symbol('R')] = R
 
-    V = L((0, 0, 0), order, symbols, M_dict, source_order=source_order).subs('R', R).subs(subsdict)
+    V = L((0, 0, 0), order, symbols, M_dict, source_order=source_order).xreplace(subsdict)
 
     terms = []
     # Note: R must be substituted late for correct derivatives!
@@ -1,17 +1,88 @@
 from sympy.printing.ccode import C99CodePrinter as C99Base
 from sympy.printing.cxxcode import CXX11CodePrinter as CXX11Base
+from sympy.printing.pycode import PythonCodePrinter as PythonBase
 import logging
 logger = logging.getLogger(name="fmmgen")
 import sympy as sp
+import textwrap
 from fmmgen.cse import cse
 from fmmgen.opts import basic as opts
 from sympy import count_ops
 
 
-class CCodePrinter(C99Base):
-    def __init__(self, settings={}, minpow=False):
+class FMAMixin:
+    """
+    Prints sums containing products as chains of fused multiply-adds,
+    i.e. a*b + c is printed as fma(a, b, c). Long sums are split into
+    several independent chains, which are added together at the end,
+    so that consecutive fma calls do not all depend on each other.
+
+    Enabled by setting self.fma to the name of the fma function.
+    """
+    fma = None
+    fma_chains = 4
+    fma_min_chain_length = 2
+
+    def _fma_split(self, term):
+        # Returns (a, b) such that term == a*b, or None if the term is not
+        # a product worth fusing.
+        c, rest = term.as_coeff_Mul()
+        if rest.is_Mul:
+            factors = rest.args
+            return c*factors[0], sp.Mul(*factors[1:])
+        elif c not in (1, -1) and not rest.is_Number:
+            return c, rest
+        return None
+
+    def _fma_chain(self, acc, products):
+        for a, b in products:
+            acc = f'{self.fma}({self._print(a)}, {self._print(b)}, {acc})'
+        return acc
+
+    def _print_Add(self, expr, order=None):
+        if not self.fma:
+            return super()._print_Add(expr, order=order)
+
+        terms = self._as_ordered_terms(expr, order=order)
+        products = []
+        others = []
+        for term in terms:
+            split = self._fma_split(term)
+            if split is None:
+                others.append(term)
+            else:
+                products.append(split)
+
+        if not products:
+            return super()._print_Add(expr, order=order)
+
+        nchains = max(1, min(self.fma_chains,
+                             len(products) // self.fma_min_chain_length))
+        chains = []
+        for i in range(nchains):
+            chain = products[i::nchains]
+            if i == 0 and others:
+                acc = self._print(sp.Add(*others))
+            else:
+                # Seed the chain with its first product.
+                a, b = chain[0]
+                acc = self._print(a*b)
+                chain = chain[1:]
+            chains.append(self._fma_chain(acc, chain))
+
+        # Sum the chains pairwise.
+        while len(chains) > 1:
+            chains = [f'({chains[i]} + {chains[i + 1]})'
+                      if i + 1 < len(chains) else chains[i]
+                      for i in range(0, len(chains), 2)]
+        return chains[0]
+
+
+class CCodePrinter(FMAMixin, C99Base):
+    def __init__(self, settings={}, minpow=False, fma=None):
         super(C99Base, self).__init__(settings)
         self.minpow = minpow
+        self.fma = fma
 
     def _print_Pow(self, expr):
         if self.minpow:
@@ -27,10 +98,11 @@ class CCodePrinter(C99Base):
             return super()._print_Pow(expr)
 
 
-class CXXCodePrinter(CXX11Base):
-    def __init__(self, settings={}, minpow=False):
+class CXXCodePrinter(FMAMixin, CXX11Base):
+    def __init__(self, settings={}, minpow=False, fma=None):
         super(CXX11Base, self).__init__(settings)
         self.minpow = minpow
+        self.fma = fma
 
     def _print_Pow(self, expr):
         if self.minpow:
@@ -45,10 +117,35 @@ class CXXCodePrinter(CXX11Base):
         else:
             return super()._print_Pow(expr)
 
+class NumbaCodePrinter(PythonBase):
+    """
+    Prints Python code which can be compiled by numba.njit. Array
+    arguments are one dimensional numpy arrays. Integer powers are left
+    to numba, which expands them itself, so minpow is ignored.
+    """
+    def __init__(self, settings={}, minpow=False):
+        super().__init__(settings)
+        self.minpow = minpow
+
+    def _print_MatrixElement(self, expr):
+        return '{}[{}]'.format(self._print(expr.parent), self._print(expr.i))
+
+    def _traverse_matrix_indices(self, mat):
+        rows, cols = mat.shape
+        return ((i, j) for i in range(rows) for j in range(cols))
+
+
 language_mapping = {'c': CCodePrinter,
                     'c++': CXXCodePrinter,
+                    'numba': NumbaCodePrinter,
                     }
 
+fma_mapping = {('c', 'double'): 'fma',
+               ('c', 'float'): 'fmaf',
+               ('c++', 'double'): 'std::fma',
+               ('c++', 'float'): 'std::fma',
+               }
+
 
 
 class SymbolIterator:
@@ -66,7 +163,8 @@ class SymbolIterator:
 
 
 class FunctionPrinter:
-    def __init__(self, language='c', precision='double', debug=True, gpu=False, minpow=False):
+    def __init__(self, language='c', precision='double', debug=True, gpu=False, minpow=False,
+                 fma=False, vector_stores=False, restrict=None, power_tables=False):
         logger.info(f"Function Printer created with precision \"{precision}\"")
 
         self.gpu = gpu
@@ -87,37 +185,161 @@ class FunctionPrinter:
         except KeyError:
             raise ValueError("Language not supported")
 
+        if fma:
+            logger.info(f"Printing sums of products as fused multiply-adds")
+            try:
+                self.printer.fma = fma_mapping[(language, precision)]
+            except KeyError:
+                raise ValueError(f"fma is not supported for language {language}")
+
+        self.vector_stores = vector_stores
+        if self.vector_stores:
+            logger.info(f"Accumulating outputs through a vectorizable loop")
+
+        # Qualifier added to the pointer arguments, e.g. 'restrict' in C
+        # or '__restrict__' in C++, to tell the compiler that the input
+        # and output arrays do not alias.
+        self.restrict = restrict
+
+        self.power_tables = power_tables
+        if self.power_tables:
+            logger.info(f"Writing tables of the powers of x, y and z")
+
         self.precision = precision
         assert self.precision in ['float', 'double']
 
-    def _array(self, name, matrix, allocate=False, operator='=', atomic=False, ignore_symbols=[]):
+    _R_statement = 'R = sqrt(x*x + y*y + z*z);'
+
+    def _declare(self, statement):
+        return f'{self.precision} {statement}\n'
+
+    def _allocate(self, name, size):
+        return f'{self.precision} {name}[{size}];\n'
+
+    def _inverse_R_powers(self, matrices):
+        """
+        Replaces the negative integer powers of R in the matrices with
+        symbols invR, invR2, invR3, ..., which are built up as a chain
+        of products, e.g. invR3 = invR*invR2 and invR5 = invR3*invR2,
+        so that no power of R is divided out more than once.
+
+        Returns the code declaring the powers, its opscount and the
+        updated matrices.
+        """
+        R = sp.Symbol('R')
+        powers = set()
+        for m in matrices:
+            powers |= {p for p in m.atoms(sp.Pow)
+                       if p.base == R and p.exp.is_Integer and p.exp < 0}
+        if not powers:
+            return "", 0, matrices
+
+        def symbol(k):
+            return sp.Symbol('invR' if k == 1 else f'invR{k}')
+
+        # Each power is computed from the one two below it, so find
+        # all of the powers which are needed along the way.
+        needed = set()
+        todo = [-p.exp for p in powers]
+        while todo:
+            k = todo.pop()
+            if k not in needed:
+                needed.add(k)
+                if k == 2:
+                    todo.append(1)
+                elif k > 2:
+                    todo += [k - 2, 2]
+
+        code = ""
         opscount = 0
+        for k in sorted(needed):
+            if k == 1:
+                expr = 1 / R
+            elif k == 2:
+                expr = sp.Mul(symbol(1), symbol(1), evaluate=False)
+            else:
+                expr = symbol(k - 2) * symbol(2)
+            opscount += count_ops(expr)
+            code += self._declare(self.printer.doprint(expr, assign_to=symbol(k)))
+
+        subsdict = {p: symbol(-p.exp) for p in powers}
+        return code, opscount, [m.xreplace(subsdict) for m in matrices]
+
+    def _power_tables(self, matrices):
+        """
+        Replaces the integer powers x**i, y**i and z**i (i >= 2) in the
+        matrices with elements of the tables mx, my and mz, which are
+        filled in once at the start of the function with
+        mx[0] = 1, mx[1] = x and mx[i] = x*mx[i - 1].
+
+        Returns the code filling in the tables, its opscount and the
+        updated matrices.
+        """
+        code = ""
+        opscount = 0
+        subsdict = {}
+        for var in sp.symbols('x y z'):
+            powers = set()
+            for m in matrices:
+                powers |= {p for p in m.atoms(sp.Pow)
+                           if p.base == var and p.exp.is_Integer and p.exp > 1}
+            if not powers:
+                continue
+
+            order = max(p.exp for p in powers)
+            table = sp.MatrixSymbol(f'm{var}', order + 1, 1)
+            code += self._allocate(table, order + 1)
+            code += self.printer.doprint(sp.S.One, assign_to=table[0]) + '\n'
+            code += self.printer.doprint(var, assign_to=table[1]) + '\n'
+            for i in range(2, order + 1):
+                expr = var * table[i - 1]
+                opscount += count_ops(expr)
+                code += self.printer.doprint(expr, assign_to=table[i]) + '\n'
+            subsdict.update({p: table[p.exp] for p in powers})
+
+        if not subsdict:
+            return "", 0, matrices
+        return code, opscount, [m.xreplace(subsdict) for m in matrices]
+
+    def _cse(self, name, matrices, ignore_symbols=[]):
+        """
+        Performs a single CSE pass over all of the matrices, so that
+        subexpressions shared between them are computed only once.
+
+        Returns the code declaring the temporaries, its opscount and the
+        reduced matrices.
+        """
+        opscount = 0
+        code = ""
+        iterator = SymbolIterator(name)
+        sub_expressions, rmatrices = cse(matrices, optimizations=opts,
+                                         symbols=iterator,
+                                         ignore=ignore_symbols)
+        rmatrices = [sp.Matrix(m) for m in rmatrices]
+
+        if self.power_tables:
+            # The tables are filled in after CSE, so that CSE can still
+            # share products of the powers between the terms.
+            temporaries = sp.Matrix([sub_expr for _, sub_expr in sub_expressions])
+            code, opscount, (temporaries, *rmatrices) = self._power_tables(
+                [temporaries] + rmatrices)
+            sub_expressions = list(zip([var for var, _ in sub_expressions],
+                                       temporaries))
+
+        for var, sub_expr in sub_expressions:
+            opscount += count_ops(sub_expr)
+            code += self._declare(self.printer.doprint(sub_expr, assign_to=var))
+        return code, opscount, rmatrices
+
+    def _array(self, name, matrix, allocate=False, operator='=', atomic=False):
         code = ""
-
-        if sp.symbols('R') in matrix.free_symbols:
-            code += f'{self.precision} R = sqrt(x*x + y*y + z*z);\n'
 
         if allocate:
-            code += f'{self.precision} {name}[{len(matrix)}];\n'
-
-        if not self.debug:
-            iterator = SymbolIterator(name)
-            # print(f'ignoring {name} in cse')
-            sub_expressions, rmatrix = cse(matrix, optimizations=opts, symbols=iterator, ignore=(ignore_symbols))
-        
-            rmatrix = sp.Matrix(rmatrix)
-            for i, (var, sub_expr) in enumerate(sub_expressions):
-                opscount += count_ops(sub_expr)
-                code += f'{self.precision} ' + self.printer.doprint(sub_expr, assign_to=var) + "\n"
-
-            opscount += count_ops(rmatrix)
-            tmp = self.printer.doprint(rmatrix, assign_to=name).replace('=',
-                                                                        operator)
+            code += self._allocate(name, len(matrix))
 
-        else:
-            opscount += count_ops(matrix)
-            tmp = self.printer.doprint(matrix, assign_to=name).replace('=',
-                                                                       operator)
+        opscount = count_ops(matrix)
+        tmp = self.printer.doprint(matrix, assign_to=name).replace('=',
+                                                                   operator)
 
         if atomic:
             lines = tmp.split('\n')
@@ -128,37 +350,77 @@ class FunctionPrinter:
             code += tmp + '\n'
         return code, opscount
 
-
-
-
     def _generate_body(self, LHS, RHS, internal=[], operator='=', atomic=False):
         # Find the reduced RHS equation.
         opscount = 0
         logger.debug(f"Generating body for LHS = {str(LHS)}")
         code = ""
-        
-        for arr_name, matrix in internal:
-            codetext, ops = self._array(arr_name, matrix, allocate=True, ignore_symbols=[arr_name])
+
+        names = [arr_name for arr_name, _ in internal]
+        matrices = [matrix for _, matrix in internal] + [RHS]
+
+        if any(sp.symbols('R') in m.free_symbols for m in matrices):
+            code += self._declare(self._R_statement)
+            codetext, ops, matrices = self._inverse_R_powers(matrices)
+            code += codetext
+            opscount += ops
+
+        if self.power_tables and self.debug:
+            codetext, ops, matrices = self._power_tables(matrices)
+            code += codetext
+            opscount += ops
+
+        if not self.debug:
+            # Subexpressions containing the internal arrays are ignored,
+            # as the shared temporaries are declared before them.
+            codetext, ops, matrices = self._cse(LHS, matrices,
+                                                ignore_symbols=names)
+            code += codetext
+            opscount += ops
+
+        for arr_name, matrix in zip(names, matrices):
+            codetext, ops = self._array(arr_name, matrix, allocate=True)
             code += codetext
             opscount += ops
-            
-        codetext, ops = self._array(LHS, RHS, operator=operator, atomic=atomic)
+
+        if self.vector_stores and operator != '=' and not atomic:
+            codetext, ops = self._vector_store(LHS, matrices[-1], operator)
+        else:
+            codetext, ops = self._array(LHS, matrices[-1], operator=operator, atomic=atomic)
         code += codetext
         opscount += ops
         return code, opscount
 
+    def _vector_store(self, LHS, matrix, operator):
+        """
+        Writes the results into a local array, which is then added to
+        the output in a single loop. As the trip count is fixed, the
+        compiler can turn the loop into full width vector loads, adds
+        and stores, rather than a separate scalar update of each element.
+        """
+        name = f'{LHS}_out'
+        code, opscount = self._array(name, matrix, allocate=True)
+        code += '#pragma omp simd\n'
+        code += f'for (int i = 0; i < {len(matrix)}; i++) {{\n'
+        code += f'{LHS}[i] {operator} {name}[i];\n'
+        code += '}\n'
+        return code, opscount
+
 
     def _generate_header(self, name, LHS, RHS, inputs):
         logger.debug(f"Generating headerfile for LHS = {str(LHS)}")
+        pointer = self.precision + ' *'
+        if self.restrict:
+            pointer += ' ' + self.restrict
         types = []
         for arg in map(type, inputs):
             if arg == sp.MatrixSymbol:
-                types.append(self.precision + ' *')
+                types.append(pointer)
             else:
                 types.append(self.precision)
 
         inputs.append(LHS)
-        types.append(self.precision + ' *')
+        types.append(pointer)
 
         combined_inputs = ', '.join([str(x) + ' ' + str(y) for x, y in
                                      zip(types, inputs)])
@@ -168,6 +430,35 @@ class FunctionPrinter:
         else:
             return "void {}({})".format(name, combined_inputs)
 
+    def generate_batch(self, name, LHS, RHS, inputs, parallel=False):
+        """
+        Generates {name}_batch, which applies the function {name} to n
+        particles, with the coordinate arguments replaced by arrays of
+        length n. The outputs of particle i are written to
+        LHS[i*len(RHS)], ... The loop is written so that the compiler can
+        inline {name} and vectorize across the particles; if parallel is
+        set, it is also split between OpenMP threads.
+        """
+        coords = [arg for arg in inputs if not isinstance(arg, sp.MatrixSymbol)]
+        args = [sp.MatrixSymbol(str(arg), 1, 1) if arg in coords else arg
+                for arg in inputs]
+        header = self._generate_header(f'{name}_batch', LHS, RHS, args)
+        header = header.replace('(', '(int n, ', 1)
+
+        call_args = [f'{arg}[i]' if arg in coords else str(arg) for arg in inputs]
+        call_args.append(f'&{LHS}[{len(RHS)}*i]')
+
+        code = header + ' {\n'
+        if parallel:
+            code += '#pragma omp parallel for simd\n'
+        else:
+            code += '#pragma omp simd\n'
+        code += 'for (int i = 0; i < n; i++) {\n'
+        code += f'{name}({", ".join(call_args)});\n'
+        code += '}\n}\n'
+        header += ';\n'
+        return header, code
+
     def generate(self, name, LHS, RHS, inputs, operator='=', atomic=False, internal=[]):
         header = self._generate_header(name, LHS, RHS, inputs)
         code = header + ' {\n'
@@ -177,3 +468,78 @@ class FunctionPrinter:
         header += ';\n'
 
         return header, code, opscount
+
+
+class NumbaFunctionPrinter(FunctionPrinter):
+    """
+    Prints the operators as Python functions compiled with numba.njit,
+    which can be called from Python without a C toolchain.
+    """
+    decorator = '@numba.njit(fastmath=True, cache=True)'
+    _R_statement = 'R = math.sqrt(x*x + y*y + z*z)'
+
+    def __init__(self, language='numba', precision='double', debug=True, gpu=False, minpow=False,
+                 fma=False, vector_stores=False, restrict=None, power_tables=False):
+        if gpu:
+            raise ValueError("Cannot write GPU functions with numba")
+        if vector_stores:
+            raise ValueError("vector_stores is not supported with numba")
+        if restrict:
+            raise ValueError("restrict is not supported with numba")
+        if power_tables:
+            # numba already expands integer powers itself.
+            raise ValueError("power_tables is not supported with numba")
+        super().__init__(language=language, precision=precision, debug=debug,
+                         minpow=minpow, fma=fma)
+
+    def _declare(self, statement):
+        return statement + '\n'
+
+    def _allocate(self, name, size):
+        if self.precision == 'float':
+            return f'{name} = np.empty({size}, dtype=np.float32)\n'
+        return f'{name} = np.empty({size})\n'
+
+    def _array(self, name, matrix, allocate=False, operator='=', atomic=False):
+        # Atomic updates are not available in numba.
+        return super()._array(name, matrix, allocate=allocate,
+                              operator=operator, atomic=False)
+
+    def _generate_header(self, name, LHS, RHS, inputs):
+        logger.debug(f"Generating definition for LHS = {str(LHS)}")
+        inputs.append(LHS)
+        return "def {}({})".format(name, ', '.join(str(x) for x in inputs))
+
+    def generate_batch(self, name, LHS, RHS, inputs, parallel=False):
+        # As FunctionPrinter.generate_batch, but each particle is passed
+        # a view of its part of the output array. With parallel set, the
+        # particles are split between threads with numba.prange.
+        header = self._generate_header(f'{name}_batch', LHS, RHS, list(inputs))
+        header = header.replace('(', '(n, ', 1)
+
+        size = len(RHS)
+        call_args = [str(arg) if isinstance(arg, sp.MatrixSymbol) else f'{arg}[i]'
+                     for arg in inputs]
+        call_args.append(f'{LHS}[{size}*i:{size}*(i + 1)]')
+
+        if parallel:
+            code = self.decorator[:-1] + ', parallel=True)\n'
+            loop = 'numba.prange(n)'
+        else:
+            code = self.decorator + '\n'
+            loop = 'range(n)'
+        code += header + ':\n'
+        code += f'    for i in {loop}:\n'
+        code += f'        {name}({", ".join(call_args)})\n'
+        header += ';\n'
+        return header, code
+
+    def generate(self, name, LHS, RHS, inputs, operator='=', atomic=False, internal=[]):
+        header = self._generate_header(name, LHS, RHS, inputs)
+        code = self.decorator + '\n' + header + ':\n'
+        codetext, opscount = self._generate_body(LHS, RHS, internal, operator, atomic=atomic)
+        code += textwrap.indent(codetext, '    ')
+        code += '\n'
+        header += ';\n'
+
+        return header, code, opscount
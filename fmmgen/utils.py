@@ -8,8 +8,6 @@
 #
 #########################################
 import sympy as sp
-from sympy.polys.orderings import monomial_key
-from sympy.polys.monomials import itermonomials as sp_itermonomials
 import functools
 
 
@@ -33,23 +31,6 @@ def Nterms(p):
         return int(sum([TriangleNumbers(i) for i in range(p + 2)]))
 
 
-def new_itermonomials(symbols, lower_order, upper_order):
-    monom_key = monomial_key('grevlex', symbols)
-    monoms = itermonomials(symbols, upper_order)
-    monoms = sorted(monoms, key=monom_key)
-    new_monoms = []
-    for monom in monoms:
-        monom_dict = monom.as_powers_dict()
-        order = 0
-        for symbol in symbols:
-            order += monom_dict[symbol]
-        if order >= lower_order:
-             new_monoms.append(monom)
-    return set(new_monoms)
-
-
-
-
 """Tools and arithmetics for monomials of distributed polynomials. """
 
 from itertools import combinations_with_replacement, product
@@ -113,16 +94,32 @@ from sympy.core import Mul, S
 
 
 def itermonomials(symbols, max_degree, min_degree=0):
-    monoms = list(sp_itermonomials(symbols, max_degree))
-    new_monoms = []
-    for monom in monoms:
-        monom_dict = monom.as_powers_dict()
-        order = 0
-        for symbol in symbols:
-            order += monom_dict[symbol]
-            if order >= min_degree:
-                new_monoms.append(monom)
-    return set(new_monoms)
+    """
+    Returns the set of exponent tuples (i, j, k), denoting the monomials
+    x**i * y**j * z**k in the symbols, whose total degree lies between
+    min_degree and max_degree inclusive.
+    """
+    return {n for n in product(range(max_degree + 1), repeat=len(symbols))
+            if min_degree <= sum(n) <= max_degree}
+
+
+# Monomial orderings on (i, j, k) exponent tuples, with the variables
+# ranked as z > y > x to match the storage order of the expansion arrays.
+def lex_key(n):
+    return n[::-1]
+
+
+def grlex_key(n):
+    return (sum(n),) + n[::-1]
+
+
+def grevlex_key(n):
+    return (sum(n),) + tuple(-i for i in n)
+
+
+monomial_keys = {'lex': lex_key,
+                 'grlex': grlex_key,
+                 'grevlex': grevlex_key}
 
 
 def generate_mappings(order, symbols, key='grevlex', source_order=0):
@@ -151,6 +148,10 @@ def generate_mappings(order, symbols, key='grevlex', source_order=0):
         Reversed version; mapping from array index to
         tuple mapping.
 
+    The mappings are cached, so the same dictionaries are returned
+    for repeated calls with the same arguments; they must therefore
+    not be modified by the caller.
+
     Example:
     >>> x, y, z = sp.symbols('x y z')
     >>> map, rmap = generate_mappings(1, [x, y, z])
@@ -159,24 +160,27 @@ def generate_mappings(order, symbols, key='grevlex', source_order=0):
     >>> print(rmap):
     {0: (0, 0, 0), 1: (1, 0, 0), 2: (0, 1, 0), 3: (0, 0, 1)}
     """
+    return _generate_mappings(order, tuple(symbols), key, source_order)
+
+
+@functools.lru_cache(maxsize=None)
+def _generate_mappings(order, symbols, key, source_order):
     if order < source_order:
         raise ValueError(
             "source_order must be <= order for meaningful calculations to occur"
         )
 
-    x, y, z = symbols
-    rsymbols = [z, y, x]
-
     monoms = itermonomials(symbols, order, source_order)
     if key:
-        monom_key = monomial_key(key, rsymbols)
+        try:
+            monom_key = monomial_keys[key]
+        except KeyError:
+            raise ValueError(f"Monomial ordering '{key}' not supported")
         monoms = sorted(monoms, key=monom_key)
 
     index_dict = {}
     rindex_dict = {}
-    for i, monom in enumerate(monoms):
-        d = monom.as_powers_dict()
-        n = d[x], d[y], d[z]
+    for i, n in enumerate(monoms):
         index_dict[n] = i
         rindex_dict[i] = n
     return index_dict, rindex_dict
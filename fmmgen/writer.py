@@ -6,7 +6,10 @@ Created on Sat Feb  9 08:41:10 2019
 @author: ryan
 """
 import os
+import glob
+import hashlib
 import subprocess
+import multiprocessing
 import sympy as sp
 from sympy import count_ops
 # from sympy.printing.fcode import FCodePrinter
@@ -29,6 +32,98 @@ q, x, y, z, R = sp.symbols('q x y z R')
 symbols = (x, y, z)
 
 
+def _write_numba_module(filename, body, funcs, start, order, source_order,
+                        osize):
+    """
+    Writes the numba functions to a Python module, along with wrapper
+    functions which take the expansion order as the final argument.
+    """
+    for func in funcs:
+        wfunc = func.replace(')', ', order)').replace(f'_{start}', '')
+        code = NumbaFunctionPrinter.decorator + '\n' + wfunc + ':\n'
+        for i in range(start, order):
+            keyword = 'if' if i == start else 'elif'
+            code += f'    {keyword} order == {i}:\n'
+            code += '        ' + func.replace(f'_{start}', f'_{i}').replace('def ', '') + '\n'
+        body += code + '\n\n'
+
+    with open(filename, 'w') as f:
+        f.write(textwrap.dedent(f"""\
+        import math
+        import numpy as np
+        import numba
+
+        FMMGEN_MINORDER = {start}
+        FMMGEN_MAXORDER = {order}
+        FMMGEN_SOURCEORDER = {source_order}
+        FMMGEN_SOURCESIZE = {Nterms(source_order) - Nterms(source_order - 1)}
+        FMMGEN_OUTPUTSIZE = {osize}
+
+
+        """))
+        f.write(body)
+
+
+
+def _source_digest():
+    """
+    Returns a SHA-256 digest of the source files of the fmmgen package,
+    which changes whenever any module used to derive the operators is
+    edited.
+    """
+    digest = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in sorted(glob.glob(os.path.join(package_dir, '*.py'))):
+        digest.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _generate_operator_expressions(order, source_order, potential, field,
+                                   harmonic_derivs, horner, P2P,
+                                   sympy_version, source_digest, pool=None):
+    """
+    Builds the symbolic expressions of the operators at a single order,
+    returning a dict of matrices keyed by operator name. This is the
+    slow stage of generate_code, and the only one which can be cached.
+
+    sympy_version and source_digest are unused, but are part of the
+    arguments so that the cache is invalidated when sympy is upgraded or
+    the fmmgen source is modified. pool is an optional
+    multiprocessing.Pool used to build the operators.
+    """
+    M_dict, _ = generate_mappings(order, symbols, 'grevlex', source_order=source_order)
+    L_dict, _ = generate_mappings(order - source_order, symbols, 'grevlex', source_order=0)
+
+    ops = {}
+    ops['M'] = sp.Matrix(generate_M_operators(order, symbols, M_dict,
+                                              pool=pool))
+    ops['Ms'] = sp.Matrix(generate_M_shift_operators(order, symbols, M_dict,
+                                                     source_order=source_order,
+                                                     pool=pool))
+    ops['derivs'] = sp.Matrix(generate_derivs(order, symbols, M_dict, source_order,
+                                              harmonic_derivs=harmonic_derivs))
+    ops['L'] = sp.Matrix(generate_L_operators(order, symbols, M_dict, L_dict,
+                                              source_order=source_order,
+                                              pool=pool))
+    ops['Ls'] = sp.Matrix(generate_L_shift_operators(order, symbols, L_dict,
+                                                     source_order=source_order,
+                                                     pool=pool))
+    ops['L2P'] = sp.Matrix(generate_L2P_operators(order, symbols, L_dict,
+                                                  potential=potential,
+                                                  field=field, horner=horner))
+    ops['M2P'] = sp.Matrix(generate_M2P_operators(order, symbols, M_dict,
+                                                  potential=potential,
+                                                  field=field, source_order=source_order,
+                                                  harmonic_derivs=harmonic_derivs))
+    if P2P:
+        ops['P2P'] = sp.Matrix(generate_P2P_operators(symbols, M_dict,
+                                                      potential=potential,
+                                                      field=field,
+                                                      source_order=source_order))
+    return ops
+
 
 def generate_code(order, name, precision='double',
                   cython=False,
@@ -36,7 +131,10 @@ def generate_code(order, name, precision='double',
                   include_dir=None, src_dir=None,
                   potential=True, field=True,
                   source_order=0, atomic=False,
-                  gpu=False, minpow=0, language='c', save_opscounts=None):
+                  gpu=False, minpow=0, language='c', save_opscounts=None,
+                  processes=1, horner=True, fma=False,
+                  vector_stores=False, cache_dir=None, restrict=False,
+                  batch=False, parallel_batch=False, power_tables=False):
     """
     Inputs:
 
@@ -55,6 +153,11 @@ def generate_code(order, name, precision='double',
     cython_wrapper, bool:
         Enable generation of a Cython wrapper for the C files.
 
+    language, str:
+        Language of the generated code; 'c', 'c++' or 'numba'. With 'numba',
+        a Python module {name}.py of numba.njit compiled functions is
+        written instead of the C source and header files.
+
     CSE, bool:
         Enable common subexpression elimination, to reduce the op count in
         the generated code.
@@ -78,17 +181,88 @@ def generate_code(order, name, precision='double',
 
     save_opcounts, string:
         Filename to save opcounts in
+
+    processes, int:
+        Number of worker processes used to build the symbolic operators.
+        Defaults to 1, which builds them in the calling process; None uses
+        all available cores. A single pool of workers is shared by all of
+        the operators. Under the spawn start method (the default on macOS
+        and Windows) the workers re-import the calling script, so scripts
+        which enable this must call generate_code from within an
+        if __name__ == '__main__': block.
+
+    horner, bool:
+        Write the L2P operators in multivariate Horner form before they
+        are printed, which reduces the op count.
+
+    fma, bool:
+        Print sums of products as chains of fused multiply-add calls
+        (fma/fmaf in C, std::fma in C++). These map onto single FMA
+        instructions when compiled for hardware which supports them
+        (e.g. with -mfma or -march=native); otherwise they are slow.
+
+    vector_stores, bool:
+        Accumulate the outputs of the operators through a local array and
+        a single '#pragma omp simd' loop, so that the compiler can emit
+        vector stores for them instead of one scalar update per element.
+        Needs -fopenmp or -fopenmp-simd for the pragma to take effect.
+        Ignored when atomic is set.
+
+    cache_dir, str:
+        Directory in which to cache the symbolic operators with joblib,
+        e.g. '~/.cache/fmmgen'. Later calls with the same order,
+        source_order, potential, field, harmonic_derivs and horner
+        settings, the same version of sympy and unmodified fmmgen source
+        files load the operators from the cache and only print the code.
+        Requires joblib.
+
+    restrict, bool:
+        Qualify the array arguments of the C/C++ functions with restrict
+        (__restrict__ in C++), promising the compiler that the input and
+        output arrays of an operator never overlap.
+
+    batch, bool:
+        Also write batched versions of the P2P, M2P and L2P operators,
+        e.g. L2P_3_batch(int n, double * x, double * y, double * z,
+        double * L, double * F), which evaluate the operator for n
+        particles at once, writing FMMGEN_OUTPUTSIZE values per particle
+        to F. As for the other operators, L2P_batch and M2P_batch take
+        the order as a final argument. The loop over particles can be
+        vectorized by the compiler once the operator is inlined into it;
+        when building a shared library, this needs
+        -fno-semantic-interposition with gcc.
+
+    parallel_batch, bool:
+        Split the particle loops of the batched operators between threads,
+        using '#pragma omp parallel for simd' in C/C++ (compile with
+        -fopenmp) and numba.prange with numba. Best left off if the
+        batched operators are called from within a parallel region.
+
+    power_tables, bool:
+        Compute the powers of x, y and z used by each operator once, in
+        tables mx[i] = x**i etc. at the start of the function, so that
+        every power is a lookup rather than a repeated product or a call
+        to pow(). Not supported with numba.
     """
     if save_opscounts:
         f = open(save_opscounts, 'w')
 
-    assert language in ['c', 'c++'], "Language must be 'c' or 'c++'"
+    assert language in ['c', 'c++', 'numba'], "Language must be 'c', 'c++' or 'numba'"
     if language == 'c':
         fext = 'c'
         hext = 'h'
     if language == 'c++':
         fext = 'cpp'
         hext = 'h'
+    if language == 'numba':
+        fext = 'py'
+        printer_class = NumbaFunctionPrinter
+    else:
+        printer_class = FunctionPrinter
+
+    restrict_keyword = None
+    if restrict:
+        restrict_keyword = '__restrict__' if language == 'c++' else 'restrict'
 
 
     logger.info(f"Generating FMM operators to order {order}")
@@ -96,10 +270,29 @@ def generate_code(order, name, precision='double',
     logger.info(f"Precision = {precision}")
     if CSE:
         logger.info(f"CSE Enabled")
-        p = FunctionPrinter(precision=precision, debug=False, minpow=minpow)
+        p = printer_class(language=language, precision=precision, debug=False,
+                          minpow=minpow,
+                          fma=fma, vector_stores=vector_stores,
+                          restrict=restrict_keyword, power_tables=power_tables)
     else:
         logger.info(f"CSE Disabled")
-        p = FunctionPrinter(precision=precision, debug=True, minpow=minpow)
+        p = printer_class(language=language, precision=precision, debug=True,
+                          minpow=minpow,
+                          fma=fma, vector_stores=vector_stores,
+                          restrict=restrict_keyword, power_tables=power_tables)
+
+    if cache_dir:
+        try:
+            import joblib
+        except ImportError:
+            raise ImportError("joblib is required to cache the operators")
+        memory = joblib.Memory(os.path.expanduser(cache_dir), verbose=0)
+        operator_expressions = memory.cache(_generate_operator_expressions,
+                                            ignore=['pool'])
+        source_digest = _source_digest()
+    else:
+        operator_expressions = _generate_operator_expressions
+        source_digest = None
 
     header = ""
     body = ""
@@ -130,21 +323,30 @@ def generate_code(order, name, precision='double',
         # leave it as a simple symbolic derivative.
         start += 1
 
-    for i in range(start, order):
-        print(f"Generating Order {i} operators")
-        M_dict, _ = generate_mappings(i, symbols,'grevlex',  source_order=source_order)
-        L_dict, _ = generate_mappings(i - source_order, symbols, 'grevlex', source_order=0)
+    pool = multiprocessing.Pool(processes) if processes != 1 else None
+    try:
+        operators = {}
+        for i in range(start, order):
+            print(f"Generating Order {i} operators")
+            operators[i] = operator_expressions(i, source_order, potential, field,
+                                                harmonic_derivs, horner, i == start,
+                                                sp.__version__, source_digest,
+                                                pool=pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
+    for i in range(start, order):
+        ops = operators[i]
 
-        M = sp.Matrix(generate_M_operators(i, symbols, M_dict))
-        
+        M = ops['M']
         head, code, P2M_opscount = p.generate(f'P2M_{i}', 'M', M,
                                 coords + [q], operator='+=')
         print(f"P2M_{i} opscount = {P2M_opscount}")
         header += head
-        body += code
-        Ms = sp.Matrix(generate_M_shift_operators(i, symbols, M_dict, source_order=source_order))
-        
+        body += code + '\n'
+        Ms = ops['Ms']
         head, code, M2M_opscount = p.generate(f'M2M_{i}', 'Ms', Ms,
                                 list(symbols) + \
                                 [sp.MatrixSymbol('M', Nterms(i), 1)],
@@ -152,11 +354,10 @@ def generate_code(order, name, precision='double',
         header += head
         body += code + '\n'
         print(f"M2M_{i} opscount = {M2M_opscount}")
-        # Two stages here; generate derivs and then the L matrix. Both
+        # Two stages here; the derivs and then the L matrix. Both
         # must be passed to the function printer.
-        derivs = sp.Matrix(generate_derivs(i, symbols, M_dict, source_order, harmonic_derivs=harmonic_derivs))
-        L = sp.Matrix(generate_L_operators(i, symbols, M_dict, L_dict,
-                      source_order=source_order))
+        derivs = ops['derivs']
+        L = ops['L']
 
         head, code, M2L_opscount = p.generate(f'M2L_{i}', 'L', L,
                                list(symbols) +  \
@@ -166,7 +367,7 @@ def generate_code(order, name, precision='double',
         body += code + '\n'
         print(f"M2L_{i} opscount = {M2L_opscount}")
 
-        Ls = sp.Matrix(generate_L_shift_operators(i, symbols, L_dict, source_order=source_order))
+        Ls = ops['Ls']
         head, code, L2L_opscount = p.generate(f'L2L_{i}', 'Ls', Ls,
                                list(symbols) + \
                                [sp.MatrixSymbol('L', Nterms(i), 1)],
@@ -175,11 +376,7 @@ def generate_code(order, name, precision='double',
         header += head
         body += code + '\n'
         print(f"L2L_{i} opscount = {L2L_opscount}")
-        L2P = generate_L2P_operators(i, symbols, L_dict,
-                                    potential=potential,
-                                    field=field)
-        
-        Fs = sp.Matrix(L2P)
+        Fs = ops['L2P']
         head, code, L2P_opscount = p.generate(f'L2P_{i}', 'F', Fs,
                                list(symbols) + \
                                [sp.MatrixSymbol('L', Nterms(i), 1)],
@@ -188,10 +385,14 @@ def generate_code(order, name, precision='double',
         header += head
         body += code + '\n'
         print(f"L2P_{i} opscount = {L2P_opscount}")
-        M2P = generate_M2P_operators(i, symbols, M_dict,
-                                     potential=potential,
-                                     field=field, source_order=source_order, harmonic_derivs=harmonic_derivs)
-        Fs = sp.Matrix(M2P)
+        if batch:
+            head, code = p.generate_batch(f'L2P_{i}', 'F', Fs,
+                                          list(symbols) + \
+                                          [sp.MatrixSymbol('L', Nterms(i), 1)],
+                                          parallel=parallel_batch)
+            header += head
+            body += code + '\n'
+        Fs = ops['M2P']
         head, code, M2P_opscount = p.generate(f'M2P_{i}', 'F', Fs,
                                 list(symbols) + \
                                 [sp.MatrixSymbol('M', Nterms(i), 1)],
@@ -199,11 +400,15 @@ def generate_code(order, name, precision='double',
         header += head
         body += code + '\n'
         print(f"M2P_{i} opscount = {M2P_opscount}")
+        if batch:
+            head, code = p.generate_batch(f'M2P_{i}', 'F', Fs,
+                                          list(symbols) + \
+                                          [sp.MatrixSymbol('M', Nterms(i), 1)],
+                                          parallel=parallel_batch)
+            header += head
+            body += code + '\n'
         if i == start:
-            P2P = sp.Matrix(generate_P2P_operators(symbols, M_dict,
-                                                   potential=potential,
-                                                   field=field,
-                                                   source_order=source_order))
+            P2P = ops['P2P']
 
             head, code, P2P_opscount = p.generate(f'P2P', 'F', P2P,
                                     list(symbols) + \
@@ -213,6 +418,13 @@ def generate_code(order, name, precision='double',
             print(f"P2P opscount = {P2P_opscount}")
             header += head
             body += code + '\n'
+            if batch:
+                head, code = p.generate_batch('P2P', 'F', P2P,
+                                              list(symbols) + \
+                                              [sp.MatrixSymbol('S', Nterms(i), 1)],
+                                              parallel=parallel_batch)
+                header += head
+                body += code + '\n'
 
         if save_opscounts:
             if i == start:
@@ -224,6 +436,13 @@ def generate_code(order, name, precision='double',
             f.write(f'L2L_{i},{L2L_opscount}\n')
             f.write(f'M2P_{i},{M2P_opscount}\n')
 
+    if potential and not field:
+        osize = 1
+    elif field and not potential:
+        osize = 3
+    elif field and potential:
+        osize = 4
+
 # We now generate wrapper functions that cover all orders generated.
     unique_funcs = []
     func_definitions = header.split(';\n')
@@ -233,8 +452,8 @@ def generate_code(order, name, precision='double',
         # for expansions > 10.
         function_name = func.split('(')[0]
         # print(f"Function_name = {function_name}")
-        end_string = f'_{start}'
-        if end_string == function_name[-len(end_string):]:
+        end_strings = (f'_{start}', f'_{start}_batch')
+        if function_name.endswith(end_strings):
             # print("Unique!")
             unique_funcs.append(func)
         else:
@@ -242,6 +461,17 @@ def generate_code(order, name, precision='double',
             # print(f"{func} not unique")
             # print(f"  {end_string}  {function_name[-len(end_string)-1:]}")
 
+    if language == 'numba':
+        if not src_dir:
+            filename = f"{name}.{fext}"
+        else:
+            filename = f"{src_dir.rstrip('/')}/{name}.{fext}"
+        _write_numba_module(filename, body, unique_funcs, start, order,
+                            source_order, osize)
+        if cython:
+            raise Warning("Cannot write a Cython wrapper for Numba code; skipping")
+        return
+
     wrapper_funcs = [f.replace(')', ', int order)').replace(f'_{start}', '')
                      for f in unique_funcs]
 
@@ -259,7 +489,9 @@ def generate_code(order, name, precision='double',
         for i in range(start, order):
             code += '  case {}:\n'.format(i)
             # print(func)
-            replaced_code = func.replace(f'_{start}', f'_{i}').replace('* ','').replace('double ','').replace('float ','').replace('void ', '')
+            replaced_code = func.replace(f'_{start}', f'_{i}').replace('* ','').replace('double ','').replace('float ','').replace('int ','').replace('void ', '')
+            if restrict_keyword:
+                replaced_code = replaced_code.replace(f'{restrict_keyword} ', '')
             # print(f"replaced_code: {replaced_code}")
             code += '    ' + replaced_code + ';\n    break;\n'
         code += "  }\n}\n"
@@ -275,12 +507,6 @@ def generate_code(order, name, precision='double',
     f.write(f"#define FMMGEN_MAXORDER {order}\n")
     f.write(f"#define FMMGEN_SOURCEORDER {source_order}\n")
     f.write(f"#define FMMGEN_SOURCESIZE {Nterms(source_order) - Nterms(source_order - 1)}\n")
-    if potential and not field:
-        osize = 1
-    elif field and not potential:
-        osize = 3
-    elif field and potential:
-        osize = 4
     f.write(f"#define FMMGEN_OUTPUTSIZE {osize}\n")
     f.write(header)
     f.close()
@@ -305,6 +531,11 @@ def generate_code(order, name, precision='double',
     elif cython:
         logger.info(f"Generating Cython wrapper: {name}_wrap.pyx")
         library = f"{name}"
+        if restrict_keyword:
+            # Cython does not understand restrict, which only matters to
+            # the C compiler anyway.
+            func_definitions = [func.replace(f' {restrict_keyword}', '')
+                                for func in func_definitions]
 
         f = open(f"{name}_decl.pxd", "w")
         pxdcode = textwrap.dedent("""\
@@ -0,0 +1,14 @@
+import fmmgen.generator as gen
+import sympy as sp
+
+x, y, z = sp.symbols('x y z')
+symbols = (x, y, z)
+
+def test_L2P_horner():
+    order = 4
+    L_dict, _ = gen.generate_mappings(order, symbols, key='grevlex', source_order=0)
+    terms = gen.generate_L2P_operators(order, symbols, L_dict)
+    horner_terms = gen.generate_L2P_operators(order, symbols, L_dict, horner=True)
+    for a, b in zip(terms, horner_terms):
+        assert sp.expand(a - b) == 0
+    assert sp.count_ops(horner_terms) < sp.count_ops(terms)
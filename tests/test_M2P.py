@@ -0,0 +1,30 @@
+import fmmgen.generator as gen
+import fmmgen.expansions as exp
+from fmmgen.utils import Nterms
+import sympy as sp
+import pytest
+
+x, y, z = sp.symbols('x y z')
+symbols = (x, y, z)
+
+def test_phi_M_deriv_matches_diff():
+    order = 3
+    source = 0
+    M = sp.MatrixSymbol('M', Nterms(order), 1)
+    M_dict, _ = gen.generate_mappings(order, symbols, key='grevlex', source_order=source)
+    R = sp.sqrt(x**2 + y**2 + z**2)
+    V = exp.phi_M_deriv(order, symbols, M_dict, source_order=source).subs('R', R)
+
+    point = {x: 0.3, y: -1.2, z: 0.7}
+    point.update({M[i]: i + 1 for i in range(Nterms(order))})
+    for deriv, s in [((1, 0, 0), x), ((0, 1, 0), y), ((0, 0, 1), z)]:
+        F = exp.phi_M_deriv(order, symbols, M_dict, deriv=deriv, source_order=source).subs('R', R)
+        assert abs((F - sp.diff(V, s)).subs(point)) < 1e-10
+
+
+def test_symengine_derivatives_match_sympy():
+    pytest.importorskip('symengine')
+    R = sp.sqrt(x**2 + y**2 + z**2)
+    for n in [(0, 0, 0), (1, 0, 0), (2, 1, 0), (1, 1, 3)]:
+        deriv = exp._symengine_inverse_R_deriv(n, symbols)
+        assert sp.expand(deriv - sp.diff(1/R, x, n[0], y, n[1], z, n[2])) == 0
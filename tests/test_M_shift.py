@@ -112,3 +112,12 @@ def test_generate_M_shift_operators_dipole():
     
 
     
+
+
+def test_generate_M_shift_operators_parallel():
+    order = 3
+    source = 0
+    M_dict, _ = gen.generate_mappings(order, symbols, key='grevlex', source_order=source)
+    serial = gen.generate_M_shift_operators(order, symbols, M_dict, source_order=source, processes=1)
+    parallel = gen.generate_M_shift_operators(order, symbols, M_dict, source_order=source, processes=2)
+    assert serial == parallel
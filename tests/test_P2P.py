@@ -0,0 +1,22 @@
+import fmmgen.generator as gen
+import sympy as sp
+
+x, y, z = sp.symbols('x y z')
+symbols = (x, y, z)
+
+
+def test_P2P_closed_forms_match_expansion():
+    for source_order in (0, 1):
+        terms = gen.generate_P2P_operators(symbols, None,
+                                           source_order=source_order)
+        expansion = gen._P2P_expansion(symbols, True, True, source_order)
+        assert len(terms) == len(expansion) == 4
+        for a, b in zip(terms, expansion):
+            assert sp.expand(a - b) == 0
+
+
+def test_P2P_closed_forms_potential_only():
+    for source_order in (0, 1):
+        V = gen.generate_P2P_operators(symbols, None, field=False,
+                                       source_order=source_order)
+        assert len(V) == 1
@@ -0,0 +1,34 @@
+import fmmgen
+import pytest
+
+
+def test_cached_operators_give_same_code(tmp_path):
+    pytest.importorskip('joblib')
+    cache_dir = str(tmp_path / 'cache')
+    for name in ('Cached0', 'Cached1'):
+        fmmgen.generate_code(3, name, CSE=True, harmonic_derivs=True,
+                             include_dir=str(tmp_path), src_dir=str(tmp_path),
+                             cache_dir=cache_dir, processes=1)
+
+    code = [(tmp_path / f'{name}.c').read_text().replace(name, '')
+            for name in ('Cached0', 'Cached1')]
+    assert code[0] == code[1]
+    assert any((tmp_path / 'cache').iterdir())
+
+
+def test_cache_invalidated_by_source_changes(tmp_path, monkeypatch):
+    pytest.importorskip('joblib')
+    cache_dir = tmp_path / 'cache'
+
+    def ncached():
+        return len(list(cache_dir.glob('**/output.pkl')))
+
+    counts = []
+    for digest in ('a', 'a', 'b'):
+        monkeypatch.setattr(fmmgen.writer, '_source_digest', lambda: digest)
+        fmmgen.generate_code(3, 'Cached', CSE=True,
+                             include_dir=str(tmp_path), src_dir=str(tmp_path),
+                             cache_dir=str(cache_dir), processes=1)
+        counts.append(ncached())
+    assert counts[0] == counts[1]
+    assert counts[2] == 2 * counts[0]
@@ -0,0 +1,87 @@
+import fmmgen
+import numpy as np
+import pytest
+from fmmgen.utils import Nterms
+
+TOTALORDER = 3
+
+def test_numba_linear_dipole():
+    pytest.importorskip('numba')
+    source_order = 0
+    order = source_order + TOTALORDER
+
+    fmmgen.generate_code(order, "NumbaLinearDipole",
+                         CSE=True,
+                         potential=True,
+                         field=True,
+                         source_order=source_order,
+                         harmonic_derivs=True,
+                         language='numba')
+
+    import NumbaLinearDipole as fmm
+    d = 1.0
+    q = 5.0
+    x1 = np.array([d, 0.0, 0.0])
+    x2 = np.array([-d, 0.0, 0.0])
+    O = np.array([0.0, 0.0, 0.0])
+
+    for Order in range(1, fmm.FMMGEN_MAXORDER):
+        Msize = Nterms(Order)
+        S_px = np.zeros(Msize)
+        S_px[0] = q
+        S_mx = np.zeros(Msize)
+        S_mx[0] = -q
+
+        M = np.zeros(Msize)
+
+        fmm.M2M(*(O-x1), S_px, M, Order)
+        fmm.M2M(*(O-x2), S_mx, M, Order)
+
+        assert M[0] == 0.0
+        assert M[1] == -2*q*d
+        assert M[2] == 0.0
+        assert M[3] == 0.0
+
+
+def test_numba_parallel_batch():
+    pytest.importorskip('numba')
+    fmmgen.generate_code(3, "NumbaBatch", CSE=True, language='numba',
+                         batch=True, parallel_batch=True)
+
+    import NumbaBatch as fmm
+    n = 10
+    rng = np.random.default_rng(0)
+    x, y, z = rng.uniform(0.5, 1.5, (3, n))
+    M = rng.uniform(-1, 1, Nterms(2))
+    F = np.zeros(fmm.FMMGEN_OUTPUTSIZE*n)
+    fmm.M2P_2_batch(n, x, y, z, M, F)
+    for i in range(n):
+        Fi = np.zeros(fmm.FMMGEN_OUTPUTSIZE)
+        fmm.M2P_2(x[i], y[i], z[i], M, Fi)
+        assert np.allclose(F[4*i:4*(i + 1)], Fi)
+
+    Fo = np.zeros_like(F)
+    fmm.M2P_batch(n, x, y, z, M, Fo, 2)
+    assert np.allclose(Fo, F)
+
+
+def test_numba_float_precision():
+    pytest.importorskip('numba')
+    for name, precision in (('NumbaDouble', 'double'), ('NumbaFloat', 'float')):
+        fmmgen.generate_code(3, name, CSE=True, language='numba',
+                             precision=precision)
+
+    import NumbaDouble
+    import NumbaFloat
+    with open('NumbaFloat.py') as f:
+        assert 'dtype=np.float32' in f.read()
+
+    rng = np.random.default_rng(0)
+    x, y, z = rng.uniform(0.5, 1.5, 3)
+    M = rng.uniform(-1, 1, Nterms(2))
+    F = np.zeros(NumbaDouble.FMMGEN_OUTPUTSIZE)
+    Ff = np.zeros(NumbaFloat.FMMGEN_OUTPUTSIZE, dtype=np.float32)
+    NumbaDouble.M2P(x, y, z, M, F, 2)
+    NumbaFloat.M2P(np.float32(x), np.float32(y), np.float32(z),
+                   M.astype(np.float32), Ff, 2)
+    assert np.allclose(Ff, F, rtol=1e-5)
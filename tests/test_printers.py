@@ -0,0 +1,101 @@
+from fmmgen.printers import CCodePrinter, CXXCodePrinter
+import sympy as sp
+
+x, y, z, a, b = sp.symbols('x y z a b')
+
+def test_fma_printing():
+    p = CCodePrinter(fma='fma')
+    assert p.doprint(x*y + z) == 'fma(x, y, z)'
+    assert p.doprint(-x*y + 1) == 'fma(-x, y, 1)'
+    assert p.doprint(x - y) == 'x - y'
+    assert CXXCodePrinter(fma='std::fma').doprint(x*y + z) == 'std::fma(x, y, z)'
+
+
+def test_fma_disabled():
+    assert CCodePrinter().doprint(x*y + z) == 'x*y + z'
+
+
+def test_fma_chains():
+    p = CCodePrinter(fma='fma')
+    code = p.doprint(a*b + a*x + b*y + x*y + 1)
+    assert code == '(fma(b, y, fma(a, b, 1)) + fma(x, y, a*x))'
+
+
+def test_inverse_R_power_chain():
+    from fmmgen.printers import FunctionPrinter
+    R = sp.Symbol('R')
+    p = FunctionPrinter(debug=False)
+    _, code, _ = p.generate('f', 'F', sp.Matrix([x/R**3, y/R**5]), [x, y, z])
+    assert 'double invR = 1.0/R;' in code
+    assert 'double invR2 = invR*invR;' in code
+    assert 'double invR3 = invR*invR2;' in code
+    assert 'double invR5 = invR2*invR3;' in code
+    assert 'pow(R' not in code
+
+
+def test_vector_stores():
+    from fmmgen.printers import FunctionPrinter
+    p = FunctionPrinter(debug=False, vector_stores=True)
+    _, code, _ = p.generate('f', 'F', sp.Matrix([x*y, x + y]), [x, y],
+                            operator='+=')
+    assert 'double F_out[2];' in code
+    assert '#pragma omp simd\nfor (int i = 0; i < 2; i++) {\nF[i] += F_out[i];\n}' in code
+
+    _, code, _ = p.generate('f', 'F', sp.Matrix([x*y, x + y]), [x, y],
+                            operator='+=', atomic=True)
+    assert 'F_out' not in code
+
+
+def test_restrict_and_batch():
+    from fmmgen.printers import FunctionPrinter
+    L = sp.MatrixSymbol('L', 4, 1)
+    p = FunctionPrinter(debug=False, restrict='restrict')
+    header, _, _ = p.generate('L2P', 'F', sp.Matrix([L[0] + x*L[1]]), [x, y, z, L])
+    assert header == 'void L2P(double x, double y, double z, double * restrict L, double * restrict F);\n'
+
+    header, code = p.generate_batch('L2P', 'F', sp.Matrix([L[0], L[1]]), [x, y, z, L])
+    assert header == ('void L2P_batch(int n, double * restrict x, double * restrict y, '
+                      'double * restrict z, double * restrict L, double * restrict F);\n')
+    assert 'L2P(x[i], y[i], z[i], L, &F[2*i]);' in code
+
+
+def test_parallel_batch():
+    from fmmgen.printers import FunctionPrinter
+    L = sp.MatrixSymbol('L', 4, 1)
+    p = FunctionPrinter(debug=False)
+    _, code = p.generate_batch('L2P', 'F', sp.Matrix([L[0]]), [x, y, z, L],
+                               parallel=True)
+    assert '#pragma omp parallel for simd\nfor (int i = 0; i < n; i++) {' in code
+
+
+def test_power_tables():
+    from fmmgen.printers import FunctionPrinter
+    for debug in (True, False):
+        p = FunctionPrinter(debug=debug, power_tables=True)
+        _, code, _ = p.generate('f', 'F', sp.Matrix([x**3 + y**2, x**2*y**2]), [x, y, z])
+        assert 'double mx[4];\nmx[0] = 1;\nmx[1] = x;\nmx[2] = x*mx[1];\nmx[3] = x*mx[2];\n' in code
+        assert 'double my[3];' in code
+        assert 'mz' not in code
+        assert 'pow(' not in code
+
+
+def test_generate_code_cxx_fma(tmp_path):
+    import fmmgen
+    fmmgen.generate_code(3, 'CXXFMA', CSE=True, language='c++', fma=True,
+                         include_dir=str(tmp_path), src_dir=str(tmp_path))
+    code = (tmp_path / 'CXXFMA.cpp').read_text()
+    assert 'std::fma(' in code
+    assert ' fma(' not in code and '(fma(' not in code
+
+
+def test_generate_code_batch_wrappers(tmp_path):
+    import fmmgen
+    fmmgen.generate_code(3, 'Batch', CSE=True, batch=True,
+                         include_dir=str(tmp_path), src_dir=str(tmp_path))
+    header = (tmp_path / 'Batch.h').read_text()
+    for op, arr in (('L2P', 'L'), ('M2P', 'M')):
+        assert (f'void {op}_batch(int n, double * x, double * y, double * z, '
+                f'double * {arr}, double * F, int order);') in header
+    assert 'void P2P_batch(int n, double * x, double * y, double * z, double * S, double * F);' in header
+    code = (tmp_path / 'Batch.c').read_text()
+    assert '  case 2:\n    L2P_2_batch(n, x, y, z, L, F);\n    break;' in code
@@ -0,0 +1,58 @@
+from fmmgen.utils import itermonomials, generate_mappings, Nterms
+import sympy as sp
+
+x, y, z = sp.symbols('x y z')
+symbols = (x, y, z)
+
+def test_itermonomials_degree_range():
+    assert itermonomials(symbols, 1) == {(0, 0, 0), (1, 0, 0),
+                                         (0, 1, 0), (0, 0, 1)}
+    assert itermonomials(symbols, 2, 2) == {(2, 0, 0), (1, 1, 0), (1, 0, 1),
+                                            (0, 2, 0), (0, 1, 1), (0, 0, 2)}
+    assert itermonomials(symbols, 1, 2) == set()
+
+
+def test_itermonomials_count():
+    for order in range(6):
+        assert len(itermonomials(symbols, order)) == Nterms(order)
+        assert len(itermonomials(symbols, order, 1)) == Nterms(order) - 1
+
+
+def test_generate_mappings_grevlex():
+    M_dict, rM_dict = generate_mappings(2, symbols, key='grevlex')
+    answer = [(0, 0, 0),
+              (1, 0, 0), (0, 1, 0), (0, 0, 1),
+              (2, 0, 0), (1, 1, 0), (1, 0, 1), (0, 2, 0), (0, 1, 1), (0, 0, 2)]
+    assert list(M_dict.keys()) == answer
+    assert [rM_dict[i] for i in range(len(answer))] == answer
+
+
+def test_generate_mappings_source_order():
+    M_dict, _ = generate_mappings(2, symbols, key='grevlex', source_order=1)
+    assert M_dict[(1, 0, 0)] == 0
+    assert M_dict[(0, 0, 2)] == 8
+    assert (0, 0, 0) not in M_dict
+
+
+def test_generate_mappings_cached():
+    a = generate_mappings(3, [x, y, z], key='grevlex', source_order=1)
+    b = generate_mappings(3, (x, y, z), key='grevlex', source_order=1)
+    assert a[0] is b[0]
+    assert a[1] is b[1]
+
+
+def test_generate_mappings_match_sympy_ordering():
+    from sympy.polys.monomials import itermonomials as sympy_itermonomials
+    from sympy.polys.orderings import monomial_key
+    for key in ('lex', 'grlex', 'grevlex'):
+        for order in range(6):
+            for source_order in range(min(order, 2) + 1):
+                M_dict, _ = generate_mappings(order, symbols, key=key,
+                                              source_order=source_order)
+                # sympy's itermonomials mishandles min_degree, so the lower
+                # orders are filtered out of the exponent tuples instead.
+                monoms = sorted(sympy_itermonomials(symbols, order),
+                                key=monomial_key(key, [z, y, x]))
+                answer = [tuple(sp.degree(m, s) for s in symbols) for m in monoms]
+                answer = [n for n in answer if sum(n) >= source_order]
+                assert list(M_dict) == answer